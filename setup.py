@@ -9,56 +9,243 @@ using mise as the runtime manager.
 
 import os
 import sys
+import pwd
+import argparse
+import json
 import subprocess
 import logging
+import functools
+import shutil
+import time
+import hashlib
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from pathlib import Path
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(message)s')
 logger = logging.getLogger(__name__)
 
+MISE_INSTALL_URL = 'https://mise.jdx.dev/install.sh'
+
+# Optional sha256 pin for the mise installer; upstream changes it every release
+MISE_INSTALL_SHA256 = os.environ.get('MISE_INSTALL_SHA256')
+
+# Root-owned, so the cached installer is out of reach of the target user
+MISE_INSTALLER_CACHE = Path('/var/cache/rails-bootstrap')
+
+# How long (in seconds) an unpinned installer download is reused for retries
+MISE_INSTALLER_RETRY_WINDOW = 600
+
+# apt package lists younger than this (in seconds) are not refreshed
+APT_LISTS_MAX_AGE = 3600
+APT_UPDATE_STAMP = Path('/var/lib/apt/periodic/update-success-stamp')
+
+# Environment preserved across sudo when running commands as the target user;
+# HOME and PATH are set explicitly since sudo overrides them
+USER_ENV_VARS = (
+    'LANG', 'LC_ALL', 'SSL_CERT_FILE', 'SSL_CERT_DIR',
+    'http_proxy', 'https_proxy', 'no_proxy', 'HTTP_PROXY', 'HTTPS_PROXY', 'NO_PROXY',
+)
+
+# Tools invoked before apt has had a chance to install anything
+REQUIRED_TOOLS = ('apt-get', 'sh', 'systemctl', 'sudo')
+
+
+@functools.lru_cache(maxsize=None)
+def _file_contains(path, mtime, needle):
+    """Check a file for a substring; mtime in the key drops stale entries."""
+    with open(path) as f:
+        return needle in f.read()
+
+
 class RailsBootstrap:
     """Bootstrap Ruby on Rails development environment on Ubuntu."""
 
-    def __init__(self):
-        self.user = 'root'
-        self.user_home = Path('/root')
+    def __init__(self, user='root'):
+        self.user = user
+        self.user_home = Path(pwd.getpwnam(user).pw_dir)
         self.mise_bin = str(self.user_home / '.local' / 'bin' / 'mise')
 
+        # Full environment for commands run as the user, so locale, proxy
+        # and CA settings survive; root's own commands must not use it,
+        # since the user can write to the bin dir put first on PATH
+        self._child_env = {
+            **os.environ,
+            'HOME': str(self.user_home),
+            'PATH': f"{self.user_home}/.local/bin:{os.environ.get('PATH', '')}"
+        }
+
+        # ca-certificates and patch would otherwise only arrive as
+        # Recommends, which apt is told to skip
         self.packages = [
-            'build-essential', 'curl', 'git', 'libpq-dev', 'zlib1g-dev',
-            'libssl-dev', 'libreadline-dev', 'libyaml-dev', 'libsqlite3-dev',
-            'sqlite3', 'libxml2-dev', 'libxslt1-dev', 'libcurl4-openssl-dev',
-            'libffi-dev', 'postgresql', 'postgresql-contrib'
+            'gnupg', 'ca-certificates', 'build-essential', 'patch', 'curl',
+            'git', 'libpq-dev', 'zlib1g-dev', 'libssl-dev', 'libreadline-dev',
+            'libyaml-dev', 'libsqlite3-dev', 'sqlite3', 'libxml2-dev',
+            'libxslt1-dev', 'libcurl4-openssl-dev', 'libffi-dev', 'postgresql',
+            'postgresql-contrib'
         ]
+        self.runtimes = ['ruby@latest', 'node@lts', 'yarn@latest']
 
-    def run_cmd(self, cmd, user=None, env=None):
-        """Execute a command."""
-        if user and user != 'root':
-            cmd = ['sudo', '-u', user, '-H'] + cmd
+        # Phases already found to be complete in this process
+        self._state = {}
 
-        result = subprocess.run(cmd, env=env, capture_output=True, text=True)
+    def _spawn(self, cmd, *, user=None, env=None, **kwargs):
+        """Run a command without checking its exit status."""
+        if user and user != 'root':
+            # sudo resets the environment; values such as proxy credentials
+            # go through --preserve-env rather than the visible command line
+            env = env or os.environ
+            preserved = {k: v for k, v in env.items() if k in USER_ENV_VARS}
+            sudo = ['sudo', '-u', user, '-H']
+            if preserved:
+                sudo.append(f"--preserve-env={','.join(preserved)}")
+            cmd = sudo + ['env', f"HOME={env.get('HOME', '')}",
+                          f"PATH={env.get('PATH', '')}"] + cmd
+            env = {**os.environ, **preserved}
+            # sudo itself runs as root, so never look it up on the user's PATH
+            search_path = os.environ.get('PATH')
+        else:
+            search_path = (env or os.environ).get('PATH')
+
+        # An absolute executable and close_fds=False let subprocess use
+        # posix_spawn instead of fork+exec; Python's own fds are created
+        # non-inheritable, so nothing leaks into the child
+        executable = shutil.which(cmd[0], path=search_path)
+        return subprocess.run(cmd, env=env, executable=executable, close_fds=False,
+                              text=True, **kwargs)
+
+    def run_cmd(self, cmd, *, user=None, env=None, input=None):
+        """Execute a command, streaming its output."""
+        result = self._spawn(cmd, user=user, env=env, input=input)
         if result.returncode != 0:
-            logger.error(f"Command failed: {' '.join(cmd)}")
-            logger.error(f"STDOUT: {result.stdout}")
-            logger.error(f"STDERR: {result.stderr}")
-            raise subprocess.CalledProcessError(result.returncode, cmd)
+            logger.error(f"Command failed: {' '.join(result.args)}")
+            raise subprocess.CalledProcessError(result.returncode, result.args)
         return result
 
+    def _missing_packages(self):
+        """Return the system packages that are not installed yet."""
+        # One dpkg-query for the whole installed set; removed packages whose
+        # config files remain are still listed, so filter on status
+        try:
+            result = self._spawn(
+                ['dpkg-query', '-W', '-f=${Package} ${db:Status-Status}\\n'],
+                capture_output=True
+            )
+        except OSError:
+            return list(self.packages)
+        if result.returncode != 0:
+            return list(self.packages)
+
+        installed = {
+            line.split()[0].split(':')[0] for line in result.stdout.splitlines()
+            if line.endswith(' installed')
+        }
+        return [pkg for pkg in self.packages if pkg not in installed]
+
+    def _apt_lists_fresh(self):
+        """Return whether apt's package lists were refreshed recently."""
+        if not any(Path('/var/lib/apt/lists').glob('*_Packages*')):
+            return False
+
+        # The success stamp is only written when a whole update succeeds;
+        # nothing else tells a fresh update apart, so without it always update
+        try:
+            return time.time() - APT_UPDATE_STAMP.stat().st_mtime < APT_LISTS_MAX_AGE
+        except FileNotFoundError:
+            return False
+
+    def _missing_runtimes(self):
+        """Return the mise runtimes not yet installed and set globally."""
+        # --global ignores versions installed only for a project, or whose
+        # `mise use --global` never ran, so those are installed and used again
+        try:
+            result = self._spawn([self.mise_bin, 'ls', '--global', '--installed', '--json'],
+                                 user=self.user, env=self._child_env, capture_output=True)
+            installed = json.loads(result.stdout) if result.returncode == 0 else {}
+        except (OSError, ValueError):
+            installed = {}
+        if not isinstance(installed, dict):
+            installed = {}
+
+        return [r for r in self.runtimes if not installed.get(r.split('@')[0])]
+
     def ensure_user(self):
-        """Ensure root home directory exists."""
-        self.user_home.mkdir(parents=True, exist_ok=True)
+        """Ensure the user's home directory exists."""
+        if self.user == 'root':
+            self.user_home.mkdir(parents=True, exist_ok=True)
+        elif not self.user_home.is_dir():
+            # Creating it here would leave it owned by root
+            raise RuntimeError(f"Home directory {self.user_home} for {self.user} does not exist")
 
     def install_packages(self):
         """Install system packages."""
-        logger.info("Installing packages...")
+        if self._state.get('packages'):
+            return
 
-        # First install gnupg which is needed for package verification
-        self.run_cmd(['apt-get', 'install', '-y', 'gnupg'])
+        missing = self._missing_packages()
+        if not missing:
+            self._state['packages'] = True
+            return
+
+        logger.info("Installing packages...")
 
-        # Now update package lists
-        self.run_cmd(['apt-get', 'update'])
-        self.run_cmd(['apt-get', 'install', '-y'] + self.packages)
+        # Root's own environment: _child_env puts the user's bin dir first
+        env = {**os.environ, 'DEBIAN_FRONTEND': 'noninteractive'}
+        apt = ['apt-get', '-o', 'Dpkg::Use-Pty=0']
+
+        if self._apt_lists_fresh():
+            logger.info("Package lists are fresh, skipping apt-get update")
+        else:
+            self.run_cmd(apt + ['update'], env=env)
+
+        # apt-fast downloads over parallel aria2 connections; use it if present
+        if shutil.which('apt-fast'):
+            install = ['apt-fast', '-o', 'Dpkg::Use-Pty=0']
+        else:
+            install = apt
+        self.run_cmd(install + ['install', '-y', '--no-install-recommends'] + missing, env=env)
+        self._state['packages'] = True
+
+    def _mise_installer(self):
+        """Return the mise install script, cached under its sha256."""
+        cache_dir = MISE_INSTALLER_CACHE
+
+        # A pinned script can be reused indefinitely; an unpinned one embeds
+        # whatever mise release was current, so only reuse it for retries
+        if MISE_INSTALL_SHA256:
+            candidates = [cache_dir / f'mise-install.sh.{MISE_INSTALL_SHA256}']
+        else:
+            now = time.time()
+            candidates = []
+            for cached in cache_dir.glob('mise-install.sh.*'):
+                if now - cached.stat().st_mtime < MISE_INSTALLER_RETRY_WINDOW:
+                    candidates.append(cached)
+                else:
+                    # Expired copies are never reused, so don't let them pile up
+                    cached.unlink(missing_ok=True)
+            candidates.sort(key=lambda p: p.stat().st_mtime, reverse=True)
+
+        # Reuse a cached copy from an earlier attempt if it is still intact
+        for script in candidates:
+            if script.exists():
+                digest = hashlib.sha256(script.read_bytes()).hexdigest()
+                if script.name == f'mise-install.sh.{digest}':
+                    return script
+
+        with urllib.request.urlopen(MISE_INSTALL_URL, timeout=30) as response:
+            data = response.read()
+
+        digest = hashlib.sha256(data).hexdigest()
+        if MISE_INSTALL_SHA256 and digest != MISE_INSTALL_SHA256:
+            raise RuntimeError(
+                f"mise installer checksum mismatch: expected {MISE_INSTALL_SHA256}, got {digest}"
+            )
+
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        script = cache_dir / f'mise-install.sh.{digest}'
+        script.write_bytes(data)
+        return script
 
     def install_mise(self):
         """Install mise."""
@@ -67,11 +254,11 @@ class RailsBootstrap:
 
         logger.info("Installing mise...")
         local_bin = self.user_home / '.local' / 'bin'
-        local_bin.mkdir(parents=True, exist_ok=True)
+        self.run_cmd(['mkdir', '-p', str(local_bin)], user=self.user, env=self._child_env)
 
-        # Install mise
-        env = {'HOME': str(self.user_home)}
-        self.run_cmd(['bash', '-c', 'curl https://mise.jdx.dev/install.sh | sh'], env=env)
+        # Feed the installer to a single sh process instead of curl | sh
+        self.run_cmd(['sh'], user=self.user, env=self._child_env,
+                     input=self._mise_installer().read_text())
 
         # Verify mise was installed
         if not (self.user_home / '.local' / 'bin' / 'mise').exists():
@@ -89,63 +276,120 @@ if command -v mise >/dev/null 2>&1; then
 fi
 '''
 
-        if bashrc.exists():
-            content = bashrc.read_text()
-            if 'mise activate' in content:
-                return
+        if self.user != 'root':
+            # Edit as the user so root never writes through links in their home
+            self.run_cmd([
+                'sh', '-c', 'grep -qs "mise activate" "$1" || printf %s "$2" >> "$1"',
+                'sh', str(bashrc), config
+            ], user=self.user, env=self._child_env)
+            return
+
+        try:
+            mtime = bashrc.stat().st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+
+        if mtime is not None and _file_contains(str(bashrc), mtime, 'mise activate'):
+            return
 
         with open(bashrc, 'a') as f:
             f.write(config)
 
     def install_runtimes(self):
         """Install Ruby, Node.js, and Yarn via mise."""
-        logger.info("Installing Ruby, Node.js, and Yarn...")
+        if self._state.get('runtimes'):
+            return
 
-        env = {
-            'HOME': str(self.user_home),
-            'PATH': f"{self.user_home}/.local/bin:{os.environ.get('PATH', '')}"
-        }
+        runtimes = self._missing_runtimes()
+        if not runtimes:
+            self._state['runtimes'] = True
+            return
 
-        for runtime in ['ruby@latest', 'node@lts', 'yarn@latest']:
-            self.run_cmd([self.mise_bin, 'install', runtime], env=env)
-            self.run_cmd([self.mise_bin, 'use', '--global', runtime], env=env)
+        logger.info("Installing Ruby, Node.js, and Yarn...")
+
+        # One invocation per step; mise installs the tools in parallel itself
+        self.run_cmd([self.mise_bin, 'install'] + runtimes,
+                     user=self.user, env=self._child_env)
+        self.run_cmd([self.mise_bin, 'use', '--global'] + runtimes,
+                     user=self.user, env=self._child_env)
+        self._state['runtimes'] = True
 
     def setup_postgresql(self):
         """Setup PostgreSQL."""
         logger.info("Setting up PostgreSQL...")
-        self.run_cmd(['systemctl', 'enable', 'postgresql'])
-        self.run_cmd(['systemctl', 'start', 'postgresql'])
-
-        # Create user if doesn't exist
-        try:
-            result = self.run_cmd([
-                'sudo', '-u', 'postgres', 'psql', '-t', '-c',
-                f"SELECT 1 FROM pg_user WHERE usename = 'root';"
-            ])
-            if '1' not in result.stdout:
-                self.run_cmd([
-                    'sudo', '-u', 'postgres', 'psql', '-c',
-                    f"CREATE USER root WITH SUPERUSER CREATEDB PASSWORD 'root';"
-                ])
-        except subprocess.CalledProcessError:
-            pass
+        self.run_cmd(['systemctl', 'enable', '--now', 'postgresql'])
+
+        # Create user if doesn't exist; psql quotes :'user' itself, and
+        # reads the query from stdin because -c skips variable interpolation
+        sql = '''
+SELECT format('CREATE USER %I WITH SUPERUSER CREATEDB PASSWORD %L', :'user', :'user')
+WHERE NOT EXISTS (SELECT FROM pg_roles WHERE rolname = :'user')
+\\gexec
+'''
+        self.run_cmd([
+            'sudo', '-u', 'postgres', 'psql', '-X', '-q',
+            '-v', 'ON_ERROR_STOP=1', '-v', f'user={self.user}'
+        ], input=sql)
 
     def install_rails(self):
         """Install Rails."""
-        logger.info("Installing Rails...")
-
-        env = {
-            'HOME': str(self.user_home),
-            'PATH': f"{self.user_home}/.local/bin:{os.environ.get('PATH', '')}"
-        }
+        if self._state.get('rails'):
+            return
 
-        cmd = '''
-        export PATH="$HOME/.local/bin:$PATH"
-        eval "$(mise activate bash)"
-        gem install rails --no-document
-        '''
+        logger.info("Installing Rails...")
 
-        self.run_cmd(['bash', '-c', cmd], env=env)
+        # --conservative makes gem skip rails if it is already installed
+        self.run_cmd([
+            self.mise_bin, 'exec', '--', 'gem', 'install', 'rails',
+            '--conservative', '--no-document'
+        ], user=self.user, env=self._child_env)
+        self._state['rails'] = True
+
+    def run_phases(self, phases):
+        """Run {name: (fn, deps)} phases, starting each once its deps are done.
+
+        After a failure no new phases start, but phases already running
+        cannot be interrupted and are waited for; every failure is then
+        reported together.
+        """
+        done = set()
+        failed = {}
+        pending = dict(phases)
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=len(phases)) as pool:
+            while running or (pending and not failed):
+                if not failed:
+                    for name, (fn, deps) in list(pending.items()):
+                        if done.issuperset(deps):
+                            logger.info(f"[{name}] started")
+                            running[pool.submit(fn)] = name
+                            del pending[name]
+
+                if not running:
+                    raise RuntimeError(f"Unsatisfiable phase dependencies: {sorted(pending)}")
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    error = future.exception()
+                    if error is None:
+                        logger.info(f"[{name}] done")
+                        done.add(name)
+                        continue
+
+                    failed[name] = error
+                    if running:
+                        still = ', '.join(sorted(running.values()))
+                        logger.error(f"[{name}] failed; waiting for {still} to finish")
+                    else:
+                        logger.error(f"[{name}] failed")
+
+        if len(failed) == 1:
+            raise next(iter(failed.values()))
+        if failed:
+            first = next(iter(failed.values()))
+            raise RuntimeError(f"Phases failed: {', '.join(failed)}") from first
 
     def run(self):
         """Execute the bootstrap process."""
@@ -153,17 +397,33 @@ fi
             logger.error("Run as root: sudo python3 setup.py")
             sys.exit(1)
 
+        missing = [tool for tool in REQUIRED_TOOLS if shutil.which(tool) is None]
+        if missing:
+            logger.error(f"Required tools not found: {', '.join(missing)}")
+            sys.exit(1)
+
         logger.info("Starting Rails environment setup...")
 
         self.ensure_user()
-        self.install_packages()
-        self.install_mise()
-        self.setup_shell()
-        self.install_runtimes()
-        self.setup_postgresql()
-        self.install_rails()
+        self.run_phases({
+            'install_packages': (self.install_packages, ()),
+            'install_mise': (self.install_mise, ('install_packages',)),
+            'setup_shell': (self.setup_shell, ('install_mise',)),
+            'install_runtimes': (self.install_runtimes, ('setup_shell',)),
+            'setup_postgresql': (self.setup_postgresql, ('install_packages',)),
+            'install_rails': (self.install_rails, ('install_runtimes',)),
+        })
 
         logger.info("✅ Setup complete! Rails environment ready.")
 
 if __name__ == '__main__':
-    RailsBootstrap().run()
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--user', default='root',
+                        help="user to set up (default: root)")
+    args = parser.parse_args()
+
+    try:
+        bootstrap = RailsBootstrap(args.user)
+    except KeyError:
+        parser.error(f"unknown user: {args.user}")
+    bootstrap.run()